@@ -2,8 +2,11 @@
 # coding: utf-8
 """
 It only handle the following two situations:
-1. There is only one primary partiion in the disk with a format of ext2/3/4 or xfs;
+1. The disk uses a MBR partition table, and the partition (primary or logical) which
+   ends last on the disk is formatted as ext2/3/4 or xfs;
 2. The disk is raw with a file system whose format is ext2/3/4 or xfs.
+In both situations the partition or raw disk can also be a LVM physical volume,
+then the logical volume on it should be ext2/3/4 or xfs.
 """
 
 import struct
@@ -12,21 +15,55 @@ import fcntl
 import time
 import sys
 import os
+import stat
 import glob
 import logging
-import commands
 import argparse
 import atexit
+import json
 import re
+import errno
+import select
+import subprocess
+import io
+import mmap
+import random
 
 BLKSSZGET = 0x1268
 BLKGETSIZE = 0x1260
 BLKRRPART = 0x125f
 BLKGETSIZE64 = 0x80041272
-NORMAL_DEVICE_NAME = r"\/dev\/\D+$"
-SPECITIAL_DEVICE_NAME = r"\/dev\/\D+\d$"
-
-logger = None
+BLKFLSBUF = 0x1261
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPER_MAGIC = 0xEF53
+EXT_FEATURE_COMPAT_HAS_JOURNAL = 0x4
+EXT_FEATURE_INCOMPAT_EXT4 = 0x40 | 0x80 | 0x200    # extents, 64bit, flex_bg
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+XFS_SUPER_MAGIC = 0x58465342                        # 'XFSB'
+LVM_LABEL_ID = 'LABELONE'
+LVM_LABEL_TYPE = 'LVM2 001'
+LVM_LABEL_SCAN_SECTORS = 4                          # LVM标签位于前4个扇区之一
+LVM_MDA_MAGIC = ' LVM2 x[5A%r0N*>'
+LVM_MDA_HEADER_SIZE = 512
+MAX_LOGICAL_PARTITIONS = 128                        # 防止EBR链成环
+SCAN_MIN_SLACK = 1024 * 1024                        # 小于1MiB的空闲空间不值得扩容
+SCAN_EXCLUDE_PREFIXES = ('ram', 'zram', 'sr', 'fd')
+# resize2fs/xfs_growfs会丢弃放不下元数据的最后一个不完整的块组/AG, 文件系统因此可能比设备小.
+# ext: 最后一个块组剩余块数 < 元数据开销+50块时被丢弃, 4K块, 256字节inode时最坏情况为
+#      inode表(每组最多32768个inode) 8MiB + 组描述符(16TiB文件系统) 8MiB + 保留GDT块(最多1024块) 4MiB
+#      + 位图/超级块 + 50块, 约20.2MiB
+# xfs: 最后一个AG小于64块时被丢弃, 4K块时不足256KiB
+VERIFY_FS_SLACK_TOLERANCE = 32 * 1024 * 1024
+COMMAND_TIMEOUT = 120
+# 耗时与文件系统大小相关的命令, 中途结束会损坏文件系统, 默认一直等待, 可用--timeout指定超时
+LONG_COMMANDS = ('e2fsck', 'xfs_repair', 'resize2fs', 'xfs_growfs', 'pvresize', 'lvextend')
+COMMAND_KILL_GRACE = 5
+FS_BLOCK_SIZE = 4096
+PENALTY_SAMPLES = 256
+
+logger = logging.getLogger('devresize')
+command_records = []
+long_command_timeout = None
 
 
 def read_ub(data):
@@ -49,6 +86,16 @@ def read_ul(data):
     return struct.unpack('<Q', data[0:8])[0]
 
 
+def read_bui(data):
+    """read big-endian unsigned int(4 bytes)"""
+    return struct.unpack('>I', data[0:4])[0]
+
+
+def read_bul(data):
+    """read big-endian unsigned long(8 bytes)"""
+    return struct.unpack('>Q', data[0:8])[0]
+
+
 def init_log():
     """初始化日志"""
     global logger
@@ -69,16 +116,135 @@ def init_log():
     logger.addHandler(stream_handler)
 
 
+class CommandResult(object):
+    """外部命令的执行结果"""
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.duration = 0.0
+        self.timed_out = False
+
+    def __str__(self):
+        return "%s: return code %s, %.3fs%s" % (' '.join(self.argv), self.returncode, self.duration,
+                                                ' (timed out)' if self.timed_out else '')
+
+
+def run_command(argv, timeout=None):
+    """不经过shell执行外部命令, 超时后依次发送SIGTERM/SIGKILL, 记录返回值和耗时
+    耗时长的命令在保存输出的同时将其实时打印到终端, 以便观察进度"""
+    echo = os.path.basename(argv[0]) in LONG_COMMANDS
+    if timeout is None and not echo:
+        timeout = COMMAND_TIMEOUT
+    elif timeout is None:
+        timeout = long_command_timeout      # None表示不限时
+    result = CommandResult(argv)
+    command_records.append(result)
+    begin = time.time()
+    try:
+        proc = subprocess.Popen(argv, stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+    except OSError, e:
+        result.returncode = 127
+        result.stderr = '%s: %s' % (argv[0], e.strerror)
+        logger.error(result.stderr)
+        return result
+
+    output = {proc.stdout: [], proc.stderr: []}
+    pending = [proc.stdout, proc.stderr]
+    deadline = begin + timeout if timeout is not None else None
+    signals_sent = 0
+    exited = False
+    while pending or proc.poll() is None:
+        if not exited and proc.poll() is not None:
+            # 命令已退出, 但其后台子进程可能仍持有输出管道, 不再长时间等待
+            exited = True
+            grace_deadline = time.time() + COMMAND_KILL_GRACE
+            deadline = grace_deadline if deadline is None else min(deadline, grace_deadline)
+        wait = deadline - time.time() if deadline is not None else 0.1
+        if wait <= 0:
+            if exited:
+                logger.debug("%s exited, output pipes are held by its children" % ' '.join(argv))
+                break
+            if signals_sent == 0:
+                result.timed_out = True
+                logger.error("%s timed out after %ds, terminate it" % (' '.join(argv), timeout))
+                proc.terminate()
+            elif signals_sent == 1:
+                proc.kill()
+            else:
+                logger.error("%s (pid %d) cannot be killed, give up waiting" % (' '.join(argv), proc.pid))
+                break
+            signals_sent += 1
+            deadline = time.time() + COMMAND_KILL_GRACE
+            continue
+        if not pending:
+            time.sleep(min(wait, 0.05))
+            continue
+        try:
+            readable, _, _ = select.select(pending, [], [], min(wait, 0.1))
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for stream in readable:
+            data = os.read(stream.fileno(), 65536)
+            if data:
+                output[stream].append(data)
+                if echo:
+                    console = sys.stdout if stream is proc.stdout else sys.stderr
+                    console.write(data)
+                    console.flush()
+            else:
+                pending.remove(stream)
+    proc.poll()
+    proc.stdout.close()
+    proc.stderr.close()
+
+    # 无法结束的命令没有返回值, 视为失败
+    result.returncode = proc.returncode if proc.returncode is not None else -1
+    result.stdout = ''.join(output[proc.stdout])
+    result.stderr = ''.join(output[proc.stderr])
+    result.duration = time.time() - begin
+    logger.debug(str(result))
+    if result.stdout:
+        logger.debug("stdout:\n%s" % result.stdout.rstrip())
+    if result.stderr and (result.returncode != 0 or result.timed_out) and not echo:
+        logger.error("%s failed, stderr:\n%s" % (' '.join(argv), result.stderr.rstrip()))
+    elif result.stderr:
+        logger.debug("stderr:\n%s" % result.stderr.rstrip())
+    return result
+
+
+def log_command_summary():
+    """记录所有外部命令的耗时"""
+    if not command_records:
+        return
+    for result in command_records:
+        logger.info(str(result))
+    logger.info("%d commands took %.3fs in total"
+                 % (len(command_records), sum(r.duration for r in command_records)))
+
+
 class PartitionEntry(object):
     """表示一个磁盘分区"""
     PartitionTypes = {
         0x05: "Microsoft Extended",
+        0x0F: "W95 Extended (LBA)",
+        0x82: "Linux swap",
         0x83: "Linux",
-        0x85: "Linux Extended"
+        0x85: "Linux Extended",
+        0x8E: "Linux LVM"
     }
+    ExtendedTypes = (0x05, 0x0F, 0x85)
 
-    def __init__(self, data):
+    def __init__(self, data, number=0, table_lba=0, base_lba=0):
         self.data = data
+        self.number = number            # 分区号, 主分区为1-4, 逻辑分区从5开始
+        self.table_lba = table_lba      # 分区项所在的MBR/EBR扇区
+        self.entry_offset = 446 + 16 * (number - 1) if 1 <= number <= 4 else 446
         self.boot_sig = data[0]
 
         self.start_head, self.start_sector, self.start_cylinder = (
@@ -89,8 +255,9 @@ class PartitionEntry(object):
         self.end_head, self.end_sector, self.end_cylinder = (
             PartitionEntry.get_hsc(data[5:5 + 3]))
 
-        self.start_lba = read_ui(data[8:8 + 4])
+        self.start_lba = base_lba + read_ui(data[8:8 + 4])     # 逻辑分区的起始扇区相对于其EBR
         self.sector_num = read_ui(data[12:12 + 4])
+        self.end_lba = self.start_lba + self.sector_num - 1
 
         self.partition_type_name = PartitionEntry.PartitionTypes.get(self.partition_type, "other")
 
@@ -105,6 +272,8 @@ class PartitionEntry(object):
     @staticmethod
     def cal_hsc(sector, hh, ss):
         """计算(head, sector, cylindar)"""
+        if sector >= 1024 * hh * ss:    # 超出CHS能表示的范围时, 按惯例使用最大值
+            sector = 1024 * hh * ss - 1
         s = sector % ss + 1
         sector /= ss
         h = sector % hh
@@ -117,9 +286,17 @@ class PartitionEntry(object):
         """校验分区类型是否在可处理的名单里"""
         return self.partition_type in self.PartitionTypes
 
-    def isprimary(self):
-        """是否为主分区"""
-        return self.partition_type == 0x83
+    def is_linux_data(self):
+        """是否为Linux数据分区(主分区或逻辑分区)"""
+        return self.partition_type in (0x83, 0x8E)
+
+    def is_extended(self):
+        """是否为扩展分区"""
+        return self.partition_type in self.ExtendedTypes
+
+    def is_logical(self):
+        """是否为逻辑分区"""
+        return self.number > 4
 
     def __str__(self):
         if not self.vaild_type():
@@ -137,19 +314,32 @@ class PartitionEntry(object):
 
 
 class MBR(object):
-    def __init__(self, data):
+    def __init__(self, data, fd=None, logical_sector_size=512):
+        """fd不为空时, 沿EBR链读取扩展分区中的逻辑分区"""
         self.data = data
         self.boot_code = data[:446]
         self.mbr_sig = data[510:512]
 
-        if self.check_mbr_sig():        # 如果存在分区
-            self.partitions = ([PartitionEntry(data[446 + 16 * i:446 + 16 * (i + 1)])
+        if self.check_mbr_sig(data):    # 如果存在分区
+            self.partitions = ([PartitionEntry(data[446 + 16 * i:446 + 16 * (i + 1)], number=i + 1)
                                 for i in range(0, 4)])
         else:                           # 否则为裸盘文件系统
             self.partitions = None
 
+        self.extended = None
+        self.logical_partitions = []
+        self.ebrs = {}                  # EBR扇区号 -> EBR数据
+        self.ebr_links = {}             # EBR扇区号 -> 前一个EBR中指向它的链接项
+        if self.partitions is not None:
+            extended = [p for p in self.partitions if p.is_extended()]
+            self.extended = extended[0] if extended else None
+            if self.extended is not None and fd is not None:
+                self.load_logical_partitions(fd, logical_sector_size)
+
+        # 与内核一致, 按扇区数判断分区项是否为空, 每个非空分区项(包括扩展分区)和逻辑分区都有设备
         if self.partitions is not None:
-            self.vaild_part_num = len(filter(lambda x: x.vaild_type(), self.partitions))
+            self.vaild_part_num = (len([p for p in self.partitions if p.sector_num != 0])
+                                   + len(self.logical_partitions))
         else:
             self.vaild_part_num = 0
 
@@ -158,20 +348,158 @@ class MBR(object):
 
         self.cal_device_hs()
 
+    def load_logical_partitions(self, fd, logical_sector_size):
+        """沿EBR链读取逻辑分区, 每个EBR的第1项为逻辑分区, 第2项指向下一个EBR"""
+        ebr_lba = self.extended.start_lba
+        while ebr_lba not in self.ebrs and len(self.ebrs) < MAX_LOGICAL_PARTITIONS:
+            fd.seek(ebr_lba * logical_sector_size)
+            data = fd.read(512)
+            if len(data) < 512 or not self.check_mbr_sig(data):
+                break
+            self.ebrs[ebr_lba] = data
+            part = PartitionEntry(data[446:446 + 16], number=5 + len(self.logical_partitions),
+                                  table_lba=ebr_lba, base_lba=ebr_lba)
+            if part.sector_num != 0:
+                self.logical_partitions.append(part)
+            # 链接项的起始扇区相对于扩展分区, 大小覆盖下一个EBR到其逻辑分区的结束位置
+            link = PartitionEntry(data[446 + 16:446 + 32], table_lba=ebr_lba,
+                                  base_lba=self.extended.start_lba)
+            link.entry_offset = 446 + 16
+            if link.sector_num == 0:
+                break
+            ebr_lba = link.start_lba
+            self.ebr_links[ebr_lba] = link
+
+    def data_partitions(self):
+        """除扩展分区外的所有分区"""
+        if self.partitions is None:
+            return []
+        return ([p for p in self.partitions if p.sector_num != 0 and not p.is_extended()]
+                + self.logical_partitions)
+
+    def find_resizable_partition(self):
+        """找到磁盘上结束位置最靠后的分区, 返回(partition, error_message)"""
+        parts = self.data_partitions()
+        if not parts:
+            return None, "no partition"
+        part = max(parts, key=lambda p: p.end_lba)
+        if not part.is_linux_data():
+            return None, "last partition %d is not a Linux partition" % part.number
+        container = self.extended if part.is_logical() else None
+        for other in self.partitions:
+            if other.sector_num != 0 and other is not part and other is not container \
+                    and other.end_lba > part.end_lba:
+                return None, "partition %d lies after partition %d" % (other.number, part.number)
+        return part, ''
+
     def cal_device_hs(self):
         """计算设备的heads和sectors"""
-        if self.partitions is not None and self.vaild_part_num == 1:
-            self.device_heads = self.partitions[0].end_head + 1
-            self.device_sectors = self.partitions[0].end_sector & 0x3F
+        if self.partitions is not None:
+            for part in self.partitions:
+                if part.sector_num != 0:
+                    self.device_heads = part.end_head + 1
+                    self.device_sectors = part.end_sector & 0x3F
+                    break
 
-    def check_mbr_sig(self):
-        """检查MBR签名"""
-        mbr_sig = read_us(self.mbr_sig)
+    @staticmethod
+    def check_mbr_sig(data):
+        """检查MBR/EBR签名"""
+        mbr_sig = read_us(data[510:512])
         if mbr_sig == 0xAA55:
             return True
         else:
             return False
 
+    def is_gpt(self):
+        """是否为GPT的保护性MBR"""
+        if self.partitions is None:
+            return False
+        return any(p.partition_type == 0xEE for p in self.partitions)
+
+
+def read_sysfs_int(path):
+    """读取sysfs中的整数属性"""
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def read_sysfs_str(path):
+    """读取sysfs中的字符串属性, 不存在时返回空字符串"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+
+def get_sysfs_dir(device):
+    """通过设备号(major:minor)找到块设备在sysfs中的目录, 与设备名无关"""
+    st = os.stat(device)
+    if not stat.S_ISBLK(st.st_mode):
+        raise OSError(errno.ENOTBLK, os.strerror(errno.ENOTBLK), device)
+    return os.path.realpath('/sys/dev/block/%d:%d' % (os.major(st.st_rdev), os.minor(st.st_rdev)))
+
+
+def is_partition_dir(sys_dir):
+    """sysfs目录对应的设备是否为分区(包括kpartx为device-mapper设备创建的分区)"""
+    if os.path.exists(os.path.join(sys_dir, 'partition')):
+        return True
+    return read_sysfs_str(os.path.join(sys_dir, 'dm/uuid')).startswith('part')
+
+
+def get_partition_devices(device):
+    """从sysfs中查找磁盘的所有分区, 返回{分区号: 设备路径}"""
+    sys_dir = get_sysfs_dir(device)
+    partitions = {}
+    for part_file in glob.glob(os.path.join(sys_dir, '*', 'partition')):
+        name = os.path.basename(os.path.dirname(part_file))
+        partitions[read_sysfs_int(part_file)] = '/dev/%s' % name
+    # device-mapper设备的分区由kpartx创建, 是磁盘的holder, 其dm uuid为part<N>-<磁盘uuid>
+    for holder in glob.glob(os.path.join(sys_dir, 'holders', '*')):
+        match = re.match(r'part(\d+)-', read_sysfs_str(os.path.join(holder, 'dm/uuid')))
+        if match:
+            dm_name = read_sysfs_str(os.path.join(holder, 'dm/name'))
+            path = '/dev/mapper/%s' % dm_name
+            if not os.path.exists(path):
+                path = '/dev/%s' % os.path.basename(holder)
+            partitions[int(match.group(1))] = path
+    return partitions
+
+
+class IOTopology(object):
+    """块设备的I/O拓扑, 来自/sys/dev/block/<major:minor>/queue"""
+
+    def __init__(self, device, logical_sector_size):
+        sys_dir = get_sysfs_dir(device)
+        self.logical_sector_size = logical_sector_size
+        self.physical_block_size = self.read_attr(sys_dir, 'queue/physical_block_size', logical_sector_size)
+        self.minimum_io_size = self.read_attr(sys_dir, 'queue/minimum_io_size', self.physical_block_size)
+        self.optimal_io_size = self.read_attr(sys_dir, 'queue/optimal_io_size', 0)
+        self.alignment_offset = max(0, self.read_attr(sys_dir, 'alignment_offset', 0))
+        # 分区边界对齐的粒度, optimal_io_size可能很大(如条带宽度), 只用于报告
+        self.grain = max(self.physical_block_size, self.minimum_io_size, logical_sector_size)
+        logger.debug("physical_block_size:%d minimum_io_size:%d optimal_io_size:%d alignment_offset:%d"
+                     % (self.physical_block_size, self.minimum_io_size,
+                        self.optimal_io_size, self.alignment_offset))
+
+    @staticmethod
+    def read_attr(sys_dir, name, default):
+        try:
+            return read_sysfs_int(os.path.join(sys_dir, name))
+        except (IOError, ValueError):
+            return default
+
+    def misalignment(self, sector, grain=None):
+        """sector相对对齐边界的偏移字节数, 0表示已对齐"""
+        grain = grain or self.grain
+        return (sector * self.logical_sector_size - self.alignment_offset) % grain
+
+    def align_end(self, end_sector):
+        """将结束扇区向下取整, 使分区结束于对齐边界"""
+        end_bytes = (end_sector + 1) * self.logical_sector_size - self.alignment_offset
+        end_bytes = end_bytes / self.grain * self.grain + self.alignment_offset
+        return end_bytes / self.logical_sector_size - 1
+
 
 def get_device_size(fd):
     """获取块设备大小"""
@@ -194,6 +522,108 @@ def get_device_size(fd):
     return device_size, device_sector_number, logical_sector_size
 
 
+def read_fs_superblock(fd, offset=0):
+    """直接读取文件系统超级块, 返回(fstype, block_size, block_count)"""
+    fd.seek(offset)
+    data = fd.read(EXT_SUPERBLOCK_OFFSET * 2)
+    if len(data) < EXT_SUPERBLOCK_OFFSET * 2:
+        return None, 0, 0
+
+    if read_bui(data[0:4]) == XFS_SUPER_MAGIC:
+        return 'xfs', read_bui(data[4:8]), read_bul(data[8:16])
+
+    sb = data[EXT_SUPERBLOCK_OFFSET:]
+    if read_us(sb[0x38:0x3A]) == EXT_SUPER_MAGIC:
+        block_size = 1024 << read_ui(sb[0x18:0x1C])
+        block_count = read_ui(sb[0x04:0x08])
+        feature_compat = read_ui(sb[0x5C:0x60])
+        feature_incompat = read_ui(sb[0x60:0x64])
+        if feature_incompat & EXT_FEATURE_INCOMPAT_64BIT:
+            block_count |= read_ui(sb[0x150:0x154]) << 32
+        if feature_incompat & EXT_FEATURE_INCOMPAT_EXT4:
+            fstype = 'ext4'
+        elif feature_compat & EXT_FEATURE_COMPAT_HAS_JOURNAL:
+            fstype = 'ext3'
+        else:
+            fstype = 'ext2'
+        return fstype, block_size, block_count
+    return None, 0, 0
+
+
+def read_pv_header(fd, offset=0):
+    """直接读取LVM物理卷标签中的pv_header, 返回(pv_uuid, [(mda_offset, mda_size)]), 不是物理卷时返回None"""
+    fd.seek(offset)
+    data = fd.read(512 * LVM_LABEL_SCAN_SECTORS)
+    for i in range(len(data) / 512):
+        label = data[512 * i:512 * (i + 1)]
+        if label[0:8] == LVM_LABEL_ID and label[24:32] == LVM_LABEL_TYPE:
+            pv_header = label[read_ui(label[20:24]):]
+            # uuid和设备大小之后依次为数据区和元数据区列表, 每项为(offset, size), 以offset为0的项结尾
+            areas, pos = [[], []], 40
+            for area_list in areas:
+                while pos + 16 <= len(pv_header) and read_ul(pv_header[pos:pos + 8]):
+                    area_list.append((read_ul(pv_header[pos:pos + 8]), read_ul(pv_header[pos + 8:pos + 16])))
+                    pos += 16
+                pos += 16
+            return pv_header[0:32], areas[1]
+    return None
+
+
+def read_lvm_label(fd, offset=0):
+    """直接读取LVM物理卷标签, 返回pv_uuid, 不是物理卷时返回None
+    标签中的设备大小在卷组中执行pvresize后不会更新, 物理卷大小需要用get_pv_size()读取"""
+    header = read_pv_header(fd, offset)
+    return header[0] if header is not None else None
+
+
+def read_pv_metadata(fd, offset=0):
+    """直接读取物理卷元数据区中的卷组文本元数据,
+    返回(extent_size, pe_start, pe_count, tail_mda_size), 大小均为字节数;
+    不是物理卷, 不在卷组中, 没有元数据区或元数据无法解析时返回None"""
+    header = read_pv_header(fd, offset)
+    if header is None:
+        return None
+    pv_uuid, mdas = header
+    for mda_offset, mda_size in mdas:
+        fd.seek(offset + mda_offset)
+        data = fd.read(mda_size)
+        if len(data) < LVM_MDA_HEADER_SIZE or data[4:20] != LVM_MDA_MAGIC:
+            continue
+        # 第一个raw_locn指向当前元数据, 元数据区是环形缓冲区, 文本可能绕回到头部之后
+        text_offset, text_size = read_ul(data[40:48]), read_ul(data[48:56])
+        if text_offset == 0 or text_size == 0:
+            continue
+        text = data[text_offset:text_offset + text_size]
+        if text_offset + text_size > mda_size:
+            text += data[LVM_MDA_HEADER_SIZE:LVM_MDA_HEADER_SIZE + text_offset + text_size - mda_size]
+        extent_size = re.search(r'^\s*extent_size\s*=\s*(\d+)', text, re.M)
+        # 物理卷的配置块中没有嵌套的{}
+        for body in re.findall(r'\{([^{}]*)\}', text):
+            fields = dict((key, value.strip().strip('"'))
+                          for key, value in re.findall(r'^\s*(\w+)\s*=\s*([^#\n]*)', body, re.M))
+            if fields.get('id', '').replace('-', '') != pv_uuid:
+                continue
+            if extent_size is None or not fields.get('pe_start', '').isdigit() \
+                    or not fields.get('pe_count', '').isdigit():
+                return None
+            # 第一个元数据区在pe_start之前, 其余的在物理卷末尾
+            tail_mda_size = sum(size for off, size in mdas[1:])
+            return (int(extent_size.group(1)) * 512, int(fields['pe_start']) * 512,
+                    int(fields['pe_count']), tail_mda_size)
+    return None
+
+
+def read_device_metadata(path):
+    """丢弃页缓存后读取块设备的大小, 文件系统超级块和LVM标签"""
+    f = open(path, 'rb')
+    try:
+        fcntl.ioctl(f, BLKFLSBUF)
+        device_size = get_device_size(f)[0]
+        return device_size, read_fs_superblock(f), read_lvm_label(f)
+    finally:
+        f.close()
+
+
 def is_ext_fs(fstype):
     return 'ext' in fstype
 
@@ -201,14 +631,14 @@ def is_ext_fs(fstype):
 def check_fs_block_size(part, fstype, mount_dir):
     """获取文件系统块大小和块数"""
     if is_ext_fs(fstype):
-        block_size = commands.getoutput("tune2fs -l %s | grep 'Block size' | awk '{print $3}'" % part)
-        # block_count = commands.getoutput("tune2fs -l %s | grep 'Block count' | awk '{print $3}'" % part)
+        output = run_command(['tune2fs', '-l', part]).stdout
+        match = re.search(r'^Block size:\s*(\d+)', output, re.M)
     else:
         mount_fs(part, mount_dir)
-        output = commands.getoutput("xfs_info %s | grep '^data' | awk  -F '[= ,]+' '{print $3, $5}'" % part).split()
+        output = run_command(['xfs_info', part]).stdout
         umount_fs(part)
-        block_size = output[0]
-        # block_count = output[1]
+        match = re.search(r'^data\s*=\s*bsize=(\d+)', output, re.M)
+    block_size = match.group(1) if match else ''
 
     if not block_size:
         logger.error("Check filesystem %s block size error, cannot get block size." % part) 
@@ -219,19 +649,23 @@ def check_fs_block_size(part, fstype, mount_dir):
         sys.exit(1)
     return mount_dir
 
-def backup_mbr(part, data):
-    """备份MBR元数据"""
-    bak_name = '/tmp/MBR_%s_%s_bak' % (os.path.basename(part), time.strftime("%Y-%m-%d_%X", time.localtime()))
+def backup_mbr(part, data, lba=0):
+    """备份MBR(lba为0)或EBR元数据"""
+    table_name = 'MBR' if lba == 0 else 'EBR%d' % lba
+    bak_name = '/tmp/%s_%s_%s_bak' % (table_name, os.path.basename(part),
+                                      time.strftime("%Y-%m-%d_%X", time.localtime()))
     bak_file = open(bak_name, 'w')
     bak_file.write(data)
     bak_file.close()
-    logger.info("Backup MBR to %s" % bak_name)
+    logger.info("Backup %s to %s" % (table_name, bak_name))
     return bak_name
 
 
-def cal_new_part(part_data, mbr, start_lab, new_end):
-    """计算新的MBR分区"""
-    device_heads, device_sectors = mbr.device_heads, mbr.device_sectors
+def cal_new_part(part, mbr, new_end):
+    """计算新的MBR/EBR分区项"""
+    # 分区表中的CHS信息为空时, 使用fdisk/parted默认的255 heads, 63 sectors
+    device_heads, device_sectors = mbr.device_heads or 255, mbr.device_sectors or 63
+    part_data, start_lab = part.data, part.start_lba
 
     new_partition_sector_num = new_end - start_lab + 1
     begin_h, begin_s, begin_c = PartitionEntry.cal_hsc(start_lab, device_heads, device_sectors)
@@ -252,46 +686,167 @@ def cal_new_part(part_data, mbr, start_lab, new_end):
     Sector Number: %u
     """ % (begin_h, begin_s, begin_c,
            end_h, end_s, end_c,
-           mbr.partitions[0].partition_type_name,
-           mbr.partitions[0].start_lba,
+           part.partition_type_name,
+           part.start_lba,
            new_partition_sector_num))
     return new_part_data
 
 
-def check_partition(dev, mbr):
-    """检查磁盘分区"""
-    resize_part_flag = True
-    target_partition = ''
+def cal_new_tables(mbr, part, new_end):
+    """计算扩容分区后的MBR/EBR, 返回{扇区号: 新数据}
+    逻辑分区还需扩容其所在的扩展分区和前一个EBR中指向它的链接项"""
+    entries = [part]
+    if part.is_logical() and part.table_lba in mbr.ebr_links:
+        entries.append(mbr.ebr_links[part.table_lba])
+    if part.is_logical() and mbr.extended.end_lba < new_end:
+        entries.append(mbr.extended)
+
+    tables = {}
+    for entry in entries:
+        if entry.table_lba in tables:
+            table = list(tables[entry.table_lba])
+        elif entry.table_lba == 0:
+            table = list(mbr.data)
+        else:
+            table = list(mbr.ebrs[entry.table_lba])
+        table[entry.entry_offset:entry.entry_offset + 16] = cal_new_part(entry, mbr, new_end)
+        tables[entry.table_lba] = ''.join(table)
+    return tables
+
+
+def cal_new_end(mbr, part, device_sector_number, topology):
+    """计算分区新的结束扇区: 结束于设备末尾最后一个对齐边界, 且不超过DOS分区表的2TB上限
+    (逻辑分区受其所在扩展分区的上限限制)
+    返回(new_end_sector, limited), limited表示是否受2TB上限限制"""
+    container = mbr.extended if part.is_logical() else part
+    new_end_sector = device_sector_number - 1
+    max_end_sector = 0xFFFFFFFF * 512 / topology.logical_sector_size + container.start_lba - 1
+    limited = new_end_sector > max_end_sector
+    new_end_sector = topology.align_end(min(new_end_sector, max_end_sector))
+    # 对齐后不能比原分区小
+    return max(new_end_sector, part.start_lba + part.sector_num - 1), limited
+
+
+def report_alignment(device, mbr, topology):
+    """报告已有分区(裸盘则为磁盘本身)的起始位置是否与物理块对齐"""
+    if mbr.partitions is None:
+        starts = [("Disk %s" % device, 0)]
+    else:
+        starts = [("Partition %d" % p.number, p.start_lba) for p in mbr.data_partitions()]
+    for name, start_lba in starts:
+        if topology.misalignment(start_lba, topology.physical_block_size):
+            logger.warn("%s starts at sector %d, which is not aligned to %d-byte physical blocks. "
+                        "Every %d-byte filesystem block straddles two physical blocks."
+                        % (name, start_lba, topology.physical_block_size, FS_BLOCK_SIZE))
+        elif topology.optimal_io_size and topology.misalignment(start_lba, topology.optimal_io_size):
+            logger.info("%s starts at sector %d, aligned to physical blocks "
+                        "but not to optimal I/O size %d bytes" % (name, start_lba, topology.optimal_io_size))
+        else:
+            logger.debug("%s starts at sector %d, aligned" % (name, start_lba))
+
+
+def measure_misalignment_penalty(device, topology, start_sector, sector_num):
+    """以O_DIRECT随机读取4K块, 返回对齐读取与按分区实际偏移读取的平均延迟(毫秒)"""
+    start = start_sector * topology.logical_sector_size
+    aligned_start = start + (topology.grain - topology.misalignment(start_sector)) % topology.grain
+    block_num = (sector_num * topology.logical_sector_size - topology.grain) / FS_BLOCK_SIZE
+    if block_num <= 0:
+        return None
+    rand = random.Random(0)
+    indexes = [rand.randrange(block_num) for _ in range(PENALTY_SAMPLES)]
+
+    f = io.FileIO(os.open(device, os.O_RDONLY | os.O_DIRECT), 'r')
+    buf = mmap.mmap(-1, FS_BLOCK_SIZE)     # O_DIRECT要求缓冲区对齐
+    aligned_time = misaligned_time = 0.0
+    try:
+        for i in indexes:   # 交替读取, 减少设备延迟波动的影响
+            begin = time.time()
+            f.seek(aligned_start + i * FS_BLOCK_SIZE)
+            f.readinto(buf)
+            aligned_time += time.time() - begin
+
+            begin = time.time()
+            f.seek(start + i * FS_BLOCK_SIZE)
+            f.readinto(buf)
+            misaligned_time += time.time() - begin
+    finally:
+        buf.close()
+        f.close()
+    return aligned_time * 1000 / PENALTY_SAMPLES, misaligned_time * 1000 / PENALTY_SAMPLES
+
+
+def dry_run(device, mbr, part, target_partition, device_sector_number, topology):
+    """只打印扩容计划和对齐情况, 不修改磁盘"""
+    logical_sector_size = topology.logical_sector_size
+    if part is not None:
+        start_sector, sector_num = part.start_lba, part.sector_num
+        new_end_sector, limited = cal_new_end(mbr, part, device_sector_number, topology)
+        logger.info("Dry run: %s sectors %d-%d (%s) -> %d-%d (%s)%s"
+                    % (target_partition, start_sector, start_sector + sector_num - 1,
+                       format_size(sector_num * logical_sector_size), start_sector, new_end_sector,
+                       format_size((new_end_sector - start_sector + 1) * logical_sector_size),
+                       ', limited to 2TB' if limited else ''))
+        if part.is_logical() and mbr.extended.end_lba < new_end_sector:
+            logger.info("Dry run: extended partition %d sectors %d-%d -> %d-%d"
+                        % (mbr.extended.number, mbr.extended.start_lba, mbr.extended.end_lba,
+                           mbr.extended.start_lba, new_end_sector))
+        if new_end_sector + 1 < device_sector_number:
+            logger.info("Dry run: %d sectors at the end of %s are left unused for alignment or 2TB limit"
+                        % (device_sector_number - new_end_sector - 1, device))
+    else:
+        start_sector, sector_num = 0, device_sector_number
+        logger.info("Dry run: %s has no partition, only resize filesystem" % device)
 
-    part_count = int(commands.getoutput("ls %s* | wc -w" % dev)) - 1
+    if not topology.misalignment(start_sector, topology.physical_block_size):
+        logger.info("Dry run: %s is aligned to %d-byte physical blocks, no misalignment penalty"
+                    % (target_partition, topology.physical_block_size))
+        return
+    latency = measure_misalignment_penalty(device, topology, start_sector, sector_num)
+    if latency is None:
+        return
+    aligned_ms, misaligned_ms = latency
+    logger.info("Dry run: %d-byte O_DIRECT read latency: aligned %.3fms, %s %.3fms, penalty %+.1f%%"
+                % (FS_BLOCK_SIZE, aligned_ms, target_partition, misaligned_ms,
+                   (misaligned_ms / aligned_ms - 1) * 100 if aligned_ms else 0))
+
+
+def check_partition(dev, mbr):
+    """检查磁盘分区, 返回(target_partition, resize_part_flag, partition)"""
+    part_devices = get_partition_devices(dev)
+    part_count = len(part_devices)
     if part_count > 0 and part_count != mbr.vaild_part_num:
-        logger.debug(commands.getoutput('ls %s*' % dev))
+        logger.debug(' '.join(part_devices.values()))
         logger.debug("%s != %s", part_count, mbr.vaild_part_num)
         logger.error("Disk %s has invalid partition" % dev)
         sys.exit(1)
 
-    if mbr.vaild_part_num > 1:
-        logger.error("Disk %s has multiple partitions." % dev)
+    if mbr.vaild_part_num == 0:  # no partition but whole disk is ext2/3/4
+        return dev, False, None
+
+    # only resize the partition which ends last on the disk
+    part, error = mbr.find_resizable_partition()
+    if part is None:
+        logger.error("Disk %s cannot be resized: %s." % (dev, error))
         sys.exit(1)
-    elif mbr.vaild_part_num == 1:  # only one partition, which is the primary partition
-        if not mbr.partitions[0].isprimary():  # and the filesystem type is ext2/3/4.
-            logger.error("Must be primary partition.")
-            sys.exit(1)
-        resize_part_flag = True
-        if dev[-1].isdigit():
-            target_partition = dev + 'p1'  # ex: /dev/nbd0 -> /dev/nbd0p1
-        else:
-            target_partition = dev + '1'  # ex: /dev/vdb -> /dev/vdb1
-        logger.debug('target_partition:%s' % target_partition)
-    elif mbr.vaild_part_num == 0:  # no partition but whole disk is ext2/3/4
-        resize_part_flag = False
-        target_partition = dev
-    return target_partition, resize_part_flag
+    if part.number not in part_devices:
+        logger.error("Cannot find partition %d of %s, please run partprobe %s." % (part.number, dev, dev))
+        sys.exit(1)
+    target_partition = part_devices[part.number]  # ex: /dev/vdb -> /dev/vdb1, /dev/nvme0n1 -> /dev/nvme0n1p1
+    logger.debug('target_partition:%s' % target_partition)
+    return target_partition, True, part
 
 
 def check_format(part):
     """检查是否为支持的分区类型"""
-    output = commands.getoutput('blkid %s' % part)
+    try:
+        with open(part, 'rb') as f:
+            # 在物理卷上直接创建文件系统时可能残留LVM标签, 以文件系统超级块为准
+            if read_fs_superblock(f)[0] is None and read_lvm_label(f) is not None:
+                return 'lvm'
+    except IOError:
+        pass
+
+    output = run_command(['blkid', part]).stdout.strip()
     if not output:
         logger.error("check filesystem format error, please ensure %s is a valid filesystem" % part)
         sys.exit(1)
@@ -303,18 +858,44 @@ def check_format(part):
     sys.exit(1)
 
 
+def check_lvm(pv, lv_name=None):
+    """检查物理卷所在的卷组, 返回要扩容的逻辑卷"""
+    vg = run_command(['pvs', '--noheadings', '-o', 'vg_name', pv]).stdout.strip()
+    if not vg:
+        logger.error("Physical volume %s does not belong to any volume group." % pv)
+        sys.exit(1)
+
+    output = run_command(['lvs', '--noheadings', '-o', 'lv_name,lv_path', vg]).stdout
+    lvs = [line.split() for line in output.splitlines() if len(line.split()) == 2]
+    if lv_name:
+        lvs = [(name, path) for name, path in lvs if lv_name in (name, path, '%s/%s' % (vg, name))]
+        if not lvs:
+            logger.error("Logical volume %s not found in volume group %s." % (lv_name, vg))
+            sys.exit(1)
+    elif len(lvs) != 1:
+        logger.error("Volume group %s has %d logical volumes, please choose one with --lv." % (vg, len(lvs)))
+        sys.exit(1)
+
+    lv_path = lvs[0][1]
+    if not os.path.exists(lv_path):
+        logger.error("Logical volume %s is not active." % lv_path)
+        sys.exit(1)
+    logger.info("Physical volume %s, volume group %s, logical volume %s" % (pv, vg, lv_path))
+    return lv_path
+
+
 def check_fs_healthy(part, fstype = 'ext'):
     """检查文件系统完整性"""
     logger.info("checking filesystem healthy")
     if is_ext_fs(fstype):
-        ret = os.system('e2fsck -af %s' % part)
-        logger.debug('e2fsck ret is %d' % ret)
+        ret = run_command(['e2fsck', '-af', part]).returncode
+        logger.debug('e2fsck ret is %s' % ret)
         if ret == 1:
             logger.info('File system errors have been corrected')
         ret = ret not in [0, 1]
     else:
-        ret = os.system('xfs_repair %s' % part)
-        logger.debug('xfs_repair ret is %d' % ret)
+        ret = run_command(['xfs_repair', part]).returncode
+        logger.debug('xfs_repair ret is %s' % ret)
     if ret:
         logger.error('File system %s error!' % part)
         sys.exit(1)
@@ -325,19 +906,30 @@ def mount_fs(part, mount_dir):
     # first need to mount fs
     if not os.path.exists(mount_dir):
         os.mkdir(mount_dir)
-    ret = os.system('mount %s %s' % (part, mount_dir))
+    ret = run_command(['mount', part, mount_dir]).returncode
     if ret != 0:
         raise RuntimeError('mount failed! (return code %s)' % ret)
     logger.info('mount %s %s' % (part, mount_dir))
 
 
+def get_mount_dir(part):
+    """从/proc/mounts中查找块设备的挂载点, 未挂载时返回空字符串"""
+    real_part = os.path.realpath(part)
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1 and os.path.realpath(fields[0]) == real_part:
+                return fields[1]
+    return ''
+
+
 def umount_fs(part):
     """解挂块设备"""
-    mount_dir = commands.getoutput("mount | grep '%s ' | awk '{print $3}'" % part)
+    mount_dir = get_mount_dir(part)
     if not mount_dir:   # if not mounted 
         return
     else:
-        ret = os.system('umount %s' % part)
+        ret = run_command(['umount', part]).returncode
         logger.info('umount %s' % part)
         if ret != 0:
             raise RuntimeError('umount failed! (return code %s)' % ret)
@@ -346,8 +938,8 @@ def umount_fs(part):
 def resize2fs(part):
     """使用resize2fs扩容ext文件系统"""
     logger.info("resize filesystem")
-    ret = os.system('resize2fs -f %s' % part)
-    logger.debug('resize2fs ret is %d' % ret)
+    ret = run_command(['resize2fs', '-f', part]).returncode
+    logger.debug('resize2fs ret is %s' % ret)
     if ret != 0:
         raise RuntimeError('resize2fs failed! (return code %s)' % ret)
 
@@ -355,16 +947,53 @@ def resize2fs(part):
 def resize_xfs(mount_dir):
     """扩容xfs文件系统"""
     logger.info("resize filesystem")
-    ret = os.system('xfs_growfs %s' % mount_dir)
-    logger.debug('xfs_growfs ret is %d' % ret)
+    ret = run_command(['xfs_growfs', mount_dir]).returncode
+    logger.debug('xfs_growfs ret is %s' % ret)
     if ret != 0:
         raise RuntimeError('xfs_growfs failed! (return code %s)' % ret)
 
 
+def get_pv_size(pv):
+    """从LVM元数据读取物理卷大小, 返回(pv_size, pe_start, extent_size, tail_mda_size)字节数,
+    读取失败时返回None. tail_mda_size为物理卷末尾元数据区(pvcreate --metadatacopies 2)的大小"""
+    output = run_command(['pvs', '--noheadings', '--units', 'b', '--nosuffix',
+                          '-o', 'pv_size,pe_start,vg_extent_size,pv_mda_count,pv_mda_size', pv]).stdout.split()
+    try:
+        if len(output) < 5:
+            return None
+        pv_size, pe_start, extent_size, mda_count, mda_size = [int(float(field)) for field in output[:5]]
+    except ValueError:
+        return None
+    # 第一个元数据区在pe_start之前, 第二个在物理卷末尾
+    return pv_size, pe_start, extent_size, mda_size if mda_count > 1 else 0
+
+
+def pvresize(pv):
+    """扩容LVM物理卷到分区大小"""
+    logger.info("resize physical volume")
+    ret = run_command(['pvresize', pv]).returncode
+    logger.debug('pvresize ret is %s' % ret)
+    if ret != 0:
+        raise RuntimeError('pvresize failed! (return code %s)' % ret)
+
+
+def lvextend(lv):
+    """将卷组的所有空闲空间分配给逻辑卷"""
+    vg = run_command(['lvs', '--noheadings', '-o', 'vg_name', lv]).stdout.strip()
+    free_count = run_command(['vgs', '--noheadings', '-o', 'vg_free_count', vg]).stdout.strip()
+    if free_count == '0':
+        logger.info("No free extents in volume group %s, try to resize filesystem" % vg)
+        return
+    logger.info("extend logical volume")
+    ret = run_command(['lvextend', '-l', '+100%FREE', lv]).returncode
+    logger.debug('lvextend ret is %s' % ret)
+    if ret != 0:
+        raise RuntimeError('lvextend failed! (return code %s)' % ret)
+
+
 def check_mount(target_dev):  # target_dev is mounted!
     """确认要扩容的块设备未挂载"""
-    output = commands.getoutput('mount | grep "%s "' % target_dev)
-    if output:
+    if get_mount_dir(target_dev):
         logger.error("Target partition %s must be unmounted." % target_dev)
         sys.exit(1)
 
@@ -375,7 +1004,7 @@ def part_probe(fd):
         logger.debug('part_probe')
     fd.flush()
     time.sleep(1)
-    ret = os.system("partprobe %s" % (fd.name))
+    ret = run_command(['partprobe', fd.name]).returncode
     if ret != 0:
         logger.error("partprobe %s returned non-zero value %s" % (fd.name, ret))
         sys.exit(1)
@@ -384,8 +1013,14 @@ def part_probe(fd):
 
 def write_mbr(fd, mbr_data):
     """将mbr数据写入文件"""
-    fd.seek(0)
-    fd.write(mbr_data)
+    write_partition_tables(fd, {0: mbr_data}, 512)
+
+
+def write_partition_tables(fd, tables, logical_sector_size):
+    """将MBR/EBR数据({扇区号: 数据})写入文件"""
+    for lba in sorted(tables):
+        fd.seek(lba * logical_sector_size)
+        fd.write(tables[lba])
     time.sleep(1)
     part_probe(fd)
     time.sleep(1)
@@ -399,40 +1034,117 @@ def check_permission(device):
 
 
 def check_args(device):
-    """检查传入的参数是否为设备名而不是分区名"""
-    exclude_devices = ["/dev/loop", "/dev/nbd"]
-    normal_device = True
-    for name in exclude_devices:
-        if device.startswith(name):
-            normal_device = False
-    if normal_device and not re.match(NORMAL_DEVICE_NAME, device):
+    """检查传入的参数是否为整块磁盘而不是分区, 返回解析符号链接后的设备路径"""
+    try:
+        sys_dir = get_sysfs_dir(device)
+    except OSError, e:
+        logger.error("%s is not a block device: %s" % (device, e.strerror))
+        sys.exit(1)
+    if is_partition_dir(sys_dir):
         logger.error("The argument should be a whole disk, not a partition! Example: /dev/vdb")
         sys.exit(1)
-    elif not normal_device and not re.match(SPECITIAL_DEVICE_NAME, device):
-        logger.error("The argument should be a whole disk, not a partition! Example: /dev/loop1")
+    real_device = os.path.realpath(device)  # ex: /dev/disk/by-id/virtio-xxx -> /dev/vdb
+    logger.debug("device:%s, sysfs:%s" % (real_device, sys_dir))
+    return real_device
+
+
+def verify_resize(fd, target_partition, fs_device, fstype, planned_part, logical_sector_size):
+    """扩容后直接读取分区表, LVM标签和文件系统超级块, 校验扩容结果是否与计划一致"""
+    errors = []
+    if planned_part is not None:
+        number, start_sector, end_sector = planned_part
+        # 重新打开设备并丢弃页缓存, 读取磁盘上实际的分区表而不是刚写入的缓存
+        f = open(fd.name, 'rb')
+        try:
+            fcntl.ioctl(f, BLKFLSBUF)
+            mbr = MBR(f.read(512), f, logical_sector_size)
+        finally:
+            f.close()
+        parts = [p for p in mbr.data_partitions() if p.number == number]
+        if not parts or (parts[0].start_lba, parts[0].end_lba) != (start_sector, end_sector):
+            errors.append("Partition %d of %s: expect sectors %d-%d, actual %s"
+                          % (number, fd.name, start_sector, end_sector,
+                             '%d-%d' % (parts[0].start_lba, parts[0].end_lba) if parts else 'missing'))
+        if number > 4 and (mbr.extended is None or mbr.extended.end_lba < end_sector):
+            errors.append("Extended partition of %s does not contain partition %d" % (fd.name, number))
+
+    part_size, superblock, pv_uuid = read_device_metadata(target_partition)
+    if planned_part is not None:
+        planned_size = (end_sector - start_sector + 1) * logical_sector_size
+        if part_size != planned_size:
+            errors.append("Kernel sees %s as %d bytes, expect %d bytes"
+                          % (target_partition, part_size, planned_size))
+
+    if fs_device != target_partition:   # 物理卷
+        pv_size = get_pv_size(target_partition)
+        if pv_uuid is None:
+            errors.append("Cannot find LVM label on %s" % target_partition)
+        elif pv_size is None:
+            errors.append("Cannot read size of physical volume %s" % target_partition)
+        else:
+            # 卷组中的物理卷大小为整数个PE, 数据区与末尾元数据区之间不足一个PE的空间无法使用
+            pv_size, pe_start, extent_size, tail_mda_size = pv_size
+            unused = part_size - pe_start - pv_size - tail_mda_size
+            if unused < 0 or unused >= max(extent_size, logical_sector_size):
+                errors.append("Physical volume %s is %d bytes from offset %d, expect %d bytes"
+                              % (target_partition, pv_size, pe_start, part_size - pe_start))
+        container_size, superblock, _ = read_device_metadata(fs_device)
+    else:
+        container_size = part_size
+    fs_type, block_size, block_count = superblock
+
+    if fs_type is None or is_ext_fs(fs_type) != is_ext_fs(fstype):
+        errors.append("Cannot find %s superblock on %s" % (fstype, fs_device))
+    else:
+        fs_size = block_size * block_count
+        planned_fs_size = container_size / block_size * block_size
+        logger.debug("filesystem block count:%d, block size:%d, planned size:%d"
+                     % (block_count, block_size, planned_fs_size))
+        if fs_size > container_size:
+            errors.append("Filesystem on %s (%d bytes) exceeds its device (%d bytes)"
+                          % (fs_device, fs_size, container_size))
+        elif planned_fs_size - fs_size > VERIFY_FS_SLACK_TOLERANCE:
+            errors.append("Filesystem on %s is %d bytes, expect %d bytes"
+                          % (fs_device, fs_size, planned_fs_size))
+
+    for error in errors:
+        logger.error(error)
+    if errors:
+        logger.error("Verify resize result failed!")
         sys.exit(1)
-    
+    logger.info("Verified: %s is %d bytes, filesystem is %d blocks of %d bytes"
+                % (fs_device, container_size, block_count, block_size))
 
 
 def check_partition_need_resize(target_partition):
     """检查分区是否可扩容"""
-    output = commands.getoutput("parted %s unit MiB print free | tail -n 2 | head -n 1" % target_partition)
-    return "Free Space" in output
+    output = run_command(['parted', target_partition, 'unit', 'MiB', 'print', 'free']).stdout
+    lines = [line for line in output.splitlines() if line.strip()]
+    return bool(lines) and "Free Space" in lines[-1]
     
 
 def check_mbr(device):
     """检查是否为mbr分区"""
-    output = commands.getoutput("parted %s print | grep 'Partition Table'" % device)
-    if 'gpt' in output:
+    output = run_command(['parted', device, 'print']).stdout
+    match = re.search(r'^Partition Table:\s*(\S+)', output, re.M)
+    if match and match.group(1) == 'gpt':
         logger.error("Not support GPT disk currently")
         sys.exit(1)
 
 
+def find_command(cmd):
+    """在PATH中查找可执行文件"""
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        filename = os.path.join(path, cmd)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
 def check_commands(command_list=[]):
     """检查运行环境和工具是否支持"""
     for cmd in command_list:
-        ret, _ = commands.getstatusoutput("which %s" % cmd)
-        if ret:
+        if find_command(cmd) is None:
             logger.error("%s: command not found" % cmd)
             sys.exit(1)
 
@@ -446,6 +1158,151 @@ def check_commands(command_list=[]):
 #     raise Exception("invalid para %s" % partation_name)
 
 
+def format_size(size):
+    """将字节数转换为便于阅读的格式"""
+    if size < 1024:
+        return '%dB' % size
+    for unit in ['K', 'M', 'G', 'T']:
+        size /= 1024.0
+        if size < 1024 or unit == 'T':
+            return '%.2f%s' % (size, unit)
+
+
+def new_scan_info(device, note=''):
+    """scan输出的一行"""
+    return {'device': device, 'size': 0, 'layout': '', 'fstype': '',
+            'partition_slack': 0, 'fs_slack': 0, 'eligible': False, 'note': note}
+
+
+def scan_device(name):
+    """不调用外部命令, 仅读取sysfs/MBR/超级块, 计算单个磁盘的可扩容空间"""
+    device = '/dev/%s' % name
+    sys_dir = '/sys/block/%s' % name
+    if is_partition_dir(sys_dir):      # kpartx创建的分区也在/sys/block中
+        return None
+    info = new_scan_info(device)
+
+    logical_sector_size = read_sysfs_int(os.path.join(sys_dir, 'queue/logical_block_size'))
+    device_size = read_sysfs_int(os.path.join(sys_dir, 'size')) * 512
+    device_sector_number = device_size / logical_sector_size
+    info['size'] = device_size
+    if device_size == 0:
+        return None
+
+    try:
+        fd = open(device, 'rb')
+    except IOError, e:
+        info['note'] = 'unreadable: %s' % e.strerror
+        return info
+
+    try:
+        mbr = MBR(fd.read(512), fd, logical_sector_size)
+        if mbr.partitions is None:
+            info['layout'] = 'raw'
+            fs_offset = 0
+            container_size = device_size
+        elif mbr.is_gpt():
+            info['layout'] = 'gpt'
+            info['note'] = 'GPT not supported'
+            return info
+        else:
+            info['layout'] = 'mbr'
+            part, error = mbr.find_resizable_partition()
+            if part is None:
+                info['note'] = error
+                return info
+            # 与main()相同, DOS分区表最多只能表示2TB, 逻辑分区受扩展分区限制
+            container = mbr.extended if part.is_logical() else part
+            max_end = min(device_sector_number,
+                          container.start_lba + 0xFFFFFFFF * 512 / logical_sector_size)
+            info['partition_slack'] = max(0, max_end - part.end_lba - 1) * logical_sector_size
+            fs_offset = part.start_lba * logical_sector_size
+            container_size = part.sector_num * logical_sector_size
+
+        fstype, block_size, block_count = read_fs_superblock(fd, fs_offset)
+        pv_uuid = read_lvm_label(fd, fs_offset) if fstype is None else None
+        pv_metadata = read_pv_metadata(fd, fs_offset) if pv_uuid is not None else None
+    except IOError, e:
+        info['note'] = 'unreadable: %s' % e.strerror
+        return info
+    finally:
+        fd.close()
+
+    if pv_uuid is not None:
+        info['fstype'] = 'lvm'
+        if pv_metadata is None:
+            info['note'] = 'PV metadata not found'
+            return info
+        # pvresize可以分配的新PE, 末尾的元数据区会被移动到新的设备末尾
+        extent_size, pe_start, pe_count, tail_mda_size = pv_metadata
+        extent_num = (container_size - pe_start - tail_mda_size) / extent_size
+        info['fs_slack'] = max(0, extent_num - pe_count) * extent_size
+    elif fstype is None:
+        info['note'] = 'unsupported filesystem'
+        return info
+    else:
+        info['fstype'] = fstype
+        info['fs_slack'] = max(0, container_size - block_size * block_count)
+
+    if pv_uuid is None and block_size != 4096:
+        info['note'] = 'block size %d' % block_size
+    elif info['partition_slack'] + info['fs_slack'] < SCAN_MIN_SLACK:
+        info['note'] = 'nothing to do'
+    else:
+        info['eligible'] = True
+    return info
+
+
+def scan(argv):
+    """扫描本机所有磁盘, 列出可扩容的磁盘"""
+    parser = argparse.ArgumentParser(prog='devresize.py scan')
+    parser.add_argument("devices", nargs='*', help="only scan these devices (default: all disks)")
+    parser.add_argument("--json", help="output in JSON format", action="store_true")
+    args = parser.parse_args(argv)
+
+    begin = time.time()
+    if args.devices:
+        devices = [(os.path.basename(os.path.realpath(d)), d) for d in args.devices]
+    else:
+        names = sorted(os.path.basename(p) for p in glob.glob('/sys/block/*'))
+        devices = [(n, None) for n in names if not n.startswith(SCAN_EXCLUDE_PREFIXES)]
+
+    results = []
+    for name, arg in devices:
+        # 用户指定的设备无法扫描时报错并输出一行, 遍历/sys/block时则直接跳过
+        if arg is not None and not os.path.isdir('/sys/block/%s' % name):
+            logger.error("%s is not a whole disk" % arg)
+            results.append(new_scan_info(arg, 'not a whole disk'))
+            continue
+        try:
+            info = scan_device(name)
+        except (IOError, OSError, ValueError), e:
+            if arg is None:
+                logger.debug("scan %s failed: %s" % (name, e))
+                continue
+            logger.error("scan %s failed: %s" % (arg, e))
+            info = new_scan_info(arg, 'scan failed: %s' % e)
+        if info is None and arg is not None:
+            logger.error("%s is empty or a partition" % arg)
+            info = new_scan_info(arg, 'empty or partition')
+        if info is not None:
+            results.append(info)
+    logger.debug("scanned %d disks in %.3fs" % (len(results), time.time() - begin))
+
+    if args.json:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        return
+
+    fmt = '%-16s %10s %-6s %-6s %12s %12s %-8s %s\n'
+    sys.stdout.write(fmt % ('DEVICE', 'SIZE', 'LAYOUT', 'FSTYPE',
+                            'PART_SLACK', 'FS_SLACK', 'ELIGIBLE', 'NOTE'))
+    for info in results:
+        sys.stdout.write(fmt % (info['device'], format_size(info['size']), info['layout'],
+                                info['fstype'] or '-', format_size(info['partition_slack']),
+                                format_size(info['fs_slack']),
+                                'yes' if info['eligible'] else 'no', info['note']))
+
+
 def closefd(fd):
     if not fd.closed:
         logger.debug("close fd")
@@ -461,18 +1318,30 @@ def main():
         4. check filesystem block size
         5. backup MBR
         6. rewrite MBR(resize partition)
-        7. resize filesystem
+        7. resize LVM physical volume and logical volume(if necessary)
+        8. resize filesystem
+        9. verify partition table and filesystem superblock
     """
+    global long_command_timeout
     init_log()
     logger.debug("user input:%s" % ' '.join(sys.argv))
+    atexit.register(log_command_summary)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'scan':
+        scan(sys.argv[2:])
+        return
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("device", help="your device path (not a partition)")
+    parser.add_argument("device", help="your device path (not a partition), symlinks such as /dev/disk/by-id/* are accepted")
     parser.add_argument("-f", "--force", help="ignore all prompts", action="store_true")
+    parser.add_argument("--lv", help="logical volume to extend if the disk is a LVM physical volume")
+    parser.add_argument("-n", "--dry-run", help="only print the resize plan and partition alignment",
+                        action="store_true")
+    parser.add_argument("--timeout", type=int, metavar="SECONDS",
+                        help="timeout of fsck, resize2fs, xfs_growfs and LVM commands (default: no timeout)")
     args = parser.parse_args()
-    device = args.device
-    
-    check_args(device)
+    device = check_args(args.device)
+    long_command_timeout = args.timeout
 
     check_permission(device)
 
@@ -482,58 +1351,76 @@ def main():
 
     fd = open(device, 'r+')
     data = fd.read(512)
-    mbr = MBR(data)
-    bak_mbr_data = ''
+    bak_tables = {}
     mount_dir = '/tmp/mount_point_%s_%s' % \
                 (os.path.basename(device), time.strftime("%Y-%m-%d_%X", time.localtime()))
     atexit.register(closefd, fd)
     
     device_size, device_sector_number, logical_sector_size = get_device_size(fd)
+
+    mbr = MBR(data, fd, logical_sector_size)
     
-    target_partition, resize_part_flag = check_partition(device, mbr)
+    topology = IOTopology(device, logical_sector_size)
+
+    target_partition, resize_part_flag, part = check_partition(device, mbr)
+
+    report_alignment(device, mbr, topology)
     
     fstype = check_format(target_partition)
 
+    fs_device = target_partition    # 文件系统所在的设备, 物理卷时为逻辑卷
+    if fstype == 'lvm':
+        check_commands(["pvs", "vgs", "lvs", "pvresize", "lvextend"])
+        fs_device = check_lvm(target_partition, args.lv)
+        fstype = check_format(fs_device)
+        if fstype == 'lvm':
+            logger.error("Only can process ext2/3/4 and xfs.")
+            sys.exit(1)
+
+    if args.dry_run:
+        dry_run(device, mbr, part, target_partition, device_sector_number, topology)
+        return
+
     if is_ext_fs(fstype):
         check_commands(["resize2fs", "e2fsck", "tune2fs"])
     else:
         check_commands(["xfs_growfs", "xfs_repair", "xfs_info"])
 
     time.sleep(1)
-    umount_fs(target_partition)
+    umount_fs(fs_device)
 
-    check_mount(target_partition)
+    check_mount(fs_device)
         
-    check_fs_healthy(target_partition, fstype)
+    check_fs_healthy(fs_device, fstype)
 
-    check_fs_block_size(target_partition, fstype, mount_dir)
+    check_fs_block_size(fs_device, fstype, mount_dir)
 
     if not args.force:
         user_input = raw_input("This operation will extend %s to the last sector of device. \n"
                             "To ensure the security of your valuable data, \n"
-                            "please create a snapshot of this volume before resize its file system, continue? [Y/n]\n" % target_partition)
+                            "please create a snapshot of this volume before resize its file system, continue? [Y/n]\n" % fs_device)
         if user_input.lower() != 'y' and user_input != '':
             logger.warn("User input neither 'y' nor '[Enter]',exit.")
             sys.exit(1)
 
     if not args.force:
         user_input = raw_input("It will resize (%s).\n"
-                    "This operation may take from several minutes to several hours, continue? [Y/n]\n" % target_partition)
+                    "This operation may take from several minutes to several hours, continue? [Y/n]\n" % fs_device)
         if user_input.lower() != 'y' and user_input != '':
             logger.warn("User input neither 'y' nor '[Enter]',exit.")
             sys.exit(1)
 
     if resize_part_flag and check_partition_need_resize(device):   # if need to resize partition
         logger.debug("Begin to change the partation")
-        if (mbr.partitions[0].start_lba + mbr.partitions[0].sector_num) == device_sector_number:
+        new_start_sector = part.start_lba
+        new_end_sector, limited = cal_new_end(mbr, part, device_sector_number, topology)
+        if new_end_sector == part.end_lba:
             logger.error("No free sectors available.")
             sys.exit(1)
-        if mbr.partitions[0].sector_num > 0xFFFFFFFF * 512 / logical_sector_size:
+        if part.sector_num > 0xFFFFFFFF * 512 / logical_sector_size:
             logger.error("Can't process the partition which have exceeded 2TB.")
             sys.exit(1)
-        new_start_sector = mbr.partitions[0].start_lba
-        new_end_sector = device_sector_number - 1
-        if (new_end_sector - new_start_sector + 1) * logical_sector_size > 0xFFFFFFFF * 512:
+        if limited:
             if not args.force:
                 user_input = raw_input("The size of this disk is %.2fTB (%d bytes).\n"
                     "But DOS partition table format can not be used on drives for volumes "
@@ -544,40 +1431,58 @@ def main():
                 if user_input.lower() != 'y' and user_input != '':
                     logger.warn("User input neither 'y' nor '[Enter]',exit.")
                     sys.exit(1)
-            new_end_sector = 0xFFFFFFFF * 512 / logical_sector_size + new_start_sector - 1
 
-        new_mbr_data = list(data)[:]
-        new_mbr_data[446:446 + 16] = cal_new_part(data[446:446 + 16], mbr,
-                                                new_start_sector, new_end_sector)
-        backup_mbr(target_partition, data)
-        bak_mbr_data = data
+        new_tables = cal_new_tables(mbr, part, new_end_sector)
+        for lba in sorted(new_tables):
+            bak_tables[lba] = data if lba == 0 else mbr.ebrs[lba]
+            backup_mbr(target_partition, bak_tables[lba], lba)
     else:
         logger.info("No need to resize partition, try to resize filesystem")
         resize_part_flag = False
 
     time.sleep(1)
-    # rewrite MBR(if necessary), resize file system
+    # rewrite MBR(if necessary), resize physical volume(if necessary), resize file system
+    pv_resized = False
+    resize_commands = len(command_records)     # 只有写入新分区表之后执行的命令超时才影响恢复MBR
     try:
         if resize_part_flag:
-            umount_fs(target_partition)
-            write_mbr(fd, ''.join(new_mbr_data))
+            umount_fs(fs_device)
+            resize_commands = len(command_records)
+            write_partition_tables(fd, new_tables, logical_sector_size)
+
+        if fs_device != target_partition:
+            pvresize(target_partition)
+            pv_resized = True
+            lvextend(fs_device)
 
-        umount_fs(target_partition)
+        umount_fs(fs_device)
         if is_ext_fs(fstype):
-            resize2fs(target_partition)
+            resize2fs(fs_device)
         else:
-            mount_fs(target_partition, mount_dir)
+            mount_fs(fs_device, mount_dir)
             resize_xfs(mount_dir)
-            umount_fs(target_partition)
+            umount_fs(fs_device)
     except Exception, e:
-        umount_fs(target_partition)
+        umount_fs(fs_device)
         logger.error(e)
         # logger.error('Some error occurred! Please make sure the e2fsprogs version is above 1.42.13.')
         logger.error('Some error occurred! Maybe you should call the customer service staff.')
-        if resize_part_flag:
+        if resize_part_flag and pv_resized:
+            # 物理卷已按新分区扩容, 恢复MBR会截断物理卷
+            logger.error('Physical volume %s has been resized, keep the new partition table' % target_partition)
+        elif resize_part_flag and any(r.timed_out for r in command_records[resize_commands:]):
+            # 超时的命令可能仍在按新分区大小修改文件系统, 恢复MBR会截断文件系统
+            logger.error('Command timed out, keep the new partition table')
+        elif resize_part_flag:
             logger.error('Resize filesystem aborted, restore MBR')
-            write_mbr(fd, bak_mbr_data)
+            write_partition_tables(fd, bak_tables, logical_sector_size)
         sys.exit(1)
+
+    if resize_part_flag:
+        verify_resize(fd, target_partition, fs_device, fstype,
+                      (part.number, new_start_sector, new_end_sector), logical_sector_size)
+    else:
+        verify_resize(fd, target_partition, fs_device, fstype, None, logical_sector_size)
     logger.info("Finished")
 
 
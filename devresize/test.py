@@ -7,8 +7,11 @@ import time
 import commands
 import tempfile
 import atexit
+import json
+import struct
 
-from devresize import main, write_mbr, read_ub, read_us, part_probe
+from devresize import main, write_mbr, read_ub, read_us, part_probe, run_command
+from devresize import IOTopology, measure_misalignment_penalty, MBR, cal_new_end
 
 devicename = None
 filename = None
@@ -137,15 +140,57 @@ class TestDeviceResize(unittest.TestCase):
     self._part_probe()
     output = commands.getoutput("python devresize.py -f %s" % self.device)
     self.assertTrue("[INFO] - Finished" in output, msg="测试只有一个分区，且为主分区的盘")
+    self.assertTrue("[INFO] - Verified: %s" % self.partition in output, msg="测试扩容后校验分区表和超级块")
 
 
   def test_multiple_part(self):
-    """测试多于一个分区的盘"""
+    """测试多于一个分区的盘, 只扩容最后一个分区"""
     self._make_part()
     self.assertEqual(commands.getstatusoutput("parted -s %s mkpart primary ext4 50%% 60%%" % self.device)[0], 0)
     self._part_probe()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %sp2" % self.device)[0], 0)
     output = commands.getoutput("python devresize.py -f %s" % self.device)
-    self.assertTrue("[ERROR] - Disk %s has multiple partitions." % self.device in output, msg="测试多于一个分区的盘")
+    self.assertTrue("[INFO] - Verified: %sp2" % self.device in output, msg="测试多于一个分区的盘")
+    self.assertTrue("[INFO] - Finished" in output, msg="测试多于一个分区的盘")
+
+
+  def test_logical_part(self):
+    """测试最后一个分区为扩展分区中的逻辑分区"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart extended 50%% 60%%" % self.device)[0], 0)
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart logical ext4 50%% 60%%" % self.device)[0], 0)
+    self._part_probe()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %sp5" % self.device)[0], 0)
+    output = commands.getoutput("python devresize.py -f %s" % self.device)
+    self.assertTrue("[INFO] - Verified: %sp5" % self.device in output, msg="测试扩容逻辑分区")
+    self.assertTrue("[INFO] - Finished" in output, msg="测试扩容逻辑分区")
+
+
+  def test_second_logical_part(self):
+    """测试扩容第二个逻辑分区时同时更新前一个EBR中的链接项"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart extended 50%% 60%%" % self.device)[0], 0)
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart logical ext4 50%% 55%%" % self.device)[0], 0)
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart logical ext4 55%% 60%%" % self.device)[0], 0)
+    self._part_probe()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %sp6" % self.device)[0], 0)
+    output = commands.getoutput("python devresize.py -f %s" % self.device)
+    self.assertTrue("[INFO] - Verified: %sp6" % self.device in output, msg="测试扩容第二个逻辑分区")
+    fd = open(self.device, 'rb')
+    mbr = MBR(fd.read(512), fd, 512)
+    fd.close()
+    part = mbr.logical_partitions[1]
+    self.assertEqual(mbr.ebr_links[part.table_lba].end_lba, part.end_lba, msg="测试更新EBR链接项")
+
+
+  def test_not_last_part(self):
+    """测试最后一个分区不是Linux分区"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("parted -s %s mkpart primary linux-swap 50%% 60%%" % self.device)[0], 0)
+    self._part_probe()
+    output = commands.getoutput("python devresize.py -f %s" % self.device)
+    self.assertTrue("[ERROR] - Disk %s cannot be resized: last partition 2 is not a Linux partition." % self.device
+                    in output, msg="测试最后一个分区不是Linux分区")
 
 
   # def test_mbr_typeflag_error(self):
@@ -162,6 +207,28 @@ class TestDeviceResize(unittest.TestCase):
     # self.assertTrue("[ERROR] - Disk %s has invalid partition type" % self.device in output, msg="测试MBR分区文件系统格式标识错误")
 
 
+  def test_partition_arg(self):
+    """测试传入分区而不是整块磁盘"""
+    self._make_part()
+    self._part_probe()
+    output = commands.getoutput("python devresize.py -f %s" % self.partition)
+    self.assertTrue("[ERROR] - The argument should be a whole disk, not a partition!" in output, msg="测试传入分区")
+
+
+  def test_device_symlink(self):
+    """测试通过符号链接(如/dev/disk/by-id/*)指定磁盘"""
+    link = os.path.join(tempfile.mkdtemp(), "disk")
+    self.addCleanup(os.rmdir, os.path.dirname(link))
+    os.symlink(self.device, link)
+    self.addCleanup(os.remove, link)
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %s" % self.partition)[0], 0)
+    self._part_probe()
+    output = commands.getoutput("python devresize.py -f %s" % link)
+    self.assertTrue("[INFO] - Verified: %s" % self.partition in output, msg="测试通过符号链接指定磁盘")
+    self.assertTrue("[INFO] - Finished" in output, msg="测试通过符号链接指定磁盘")
+
+
   def test_mounted(self):
     """测试磁盘已有分区mount"""
     if not os.path.exists("mp"):
@@ -222,6 +289,96 @@ class TestDeviceResize(unittest.TestCase):
     self.assertTrue("[ERROR] - Not support GPT disk currently" in output, msg="测试GPT格式的磁盘")
 
 
+  def test_verify_mismatch(self):
+    """测试扩容后文件系统大小与计划不一致时校验失败"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %s" % self.partition)[0], 0)
+    self._part_probe()
+    output = commands.getoutput("python devresize.py -f %s" % self.device)
+    self.assertTrue("[INFO] - Finished" in output)
+    self.assertEqual(commands.getstatusoutput("e2fsck -f -y %s" % self.partition)[0], 0)
+    self.assertEqual(commands.getstatusoutput("resize2fs %s 1G" % self.partition)[0], 0)
+    output = commands.getoutput("python -c \"import devresize as d; d.init_log(); "
+                                "d.verify_resize(open('%s', 'r+'), '%s', '%s', 'ext4', None, 512)\""
+                                % (self.device, self.partition, self.partition))
+    self.assertTrue("[ERROR] - Verify resize result failed!" in output, msg="测试校验缩小后的文件系统")
+
+
+  def test_lvm(self):
+    """测试分区为LVM物理卷"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("parted -s %s set 1 lvm on" % self.device)[0], 0)
+    self._part_probe()
+    self.assertEqual(commands.getstatusoutput("pvcreate -ff -y %s" % self.partition)[0], 0)
+    self.assertEqual(commands.getstatusoutput("vgcreate devresize_test %s" % self.partition)[0], 0)
+    self.addCleanup(commands.getoutput, "vgremove -f devresize_test")
+    self.assertEqual(commands.getstatusoutput("lvcreate -y -l 100%FREE -n data devresize_test")[0], 0)
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F /dev/devresize_test/data")[0], 0)
+    output = commands.getoutput("python devresize.py -f %s" % self.device)
+    self.assertTrue("[INFO] - Verified: /dev/devresize_test/data" in output, msg="测试扩容逻辑卷上的文件系统")
+    self.assertTrue("[INFO] - Finished" in output, msg="测试分区为LVM物理卷")
+
+
+  def test_dry_run(self):
+    """测试只打印扩容计划, 不修改分区表"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F %s" % self.partition)[0], 0)
+    self._part_probe()
+    before = commands.getoutput("parted -s %s unit s print" % self.device)
+    output = commands.getoutput("python devresize.py -f --dry-run %s" % self.device)
+    self.assertTrue("[INFO] - Dry run: %s sectors" % self.partition in output, msg="测试打印扩容计划")
+    self.assertFalse("[INFO] - Finished" in output)
+    self.assertEqual(before, commands.getoutput("parted -s %s unit s print" % self.device), msg="测试不修改分区表")
+
+
+  def test_scan(self):
+    """测试扫描可扩容的磁盘"""
+    self._make_part()
+    self.assertEqual(commands.getstatusoutput("mkfs.ext4 -F -b 4096 %s" % self.partition)[0], 0)
+    self._part_probe()
+    output = commands.getoutput("python devresize.py scan --json %s" % self.device)
+    info = json.loads(output)[0]
+    self.assertEqual(info["layout"], "mbr")
+    self.assertEqual(info["fstype"], "ext4")
+    self.assertTrue(info["partition_slack"] > 0, msg="测试扫描分区空闲空间")
+    self.assertTrue(info["eligible"], msg="测试扫描可扩容的磁盘")
+
+
+  def test_command_timeout(self):
+    """测试外部命令超时"""
+    begin = time.time()
+    result = run_command(["sleep", "60"], timeout=1)
+    self.assertTrue(result.timed_out, msg="测试外部命令超时")
+    self.assertNotEqual(result.returncode, 0)
+    self.assertTrue(time.time() - begin < 10, msg="测试超时后结束外部命令")
+
+
+  def test_aligned_end(self):
+    """测试新的结束扇区按4K物理块和alignment_offset对齐, 且不小于原分区的结束扇区"""
+    topology = IOTopology(self.device, 512)
+    topology.physical_block_size = topology.grain = 4096
+    topology.alignment_offset = 3584
+    entry = '\0' * 4 + chr(0x83) + '\0' * 3 + struct.pack('<II', 63, 20000000)
+    mbr = MBR('\0' * 446 + entry + '\0' * 48 + '\x55\xaa')
+    part = mbr.partitions[0]
+    for device_sector_number in (20000063, 20000070, 20971520, 20971523):
+      end, limited = cal_new_end(mbr, part, device_sector_number, topology)
+      self.assertFalse(limited)
+      self.assertTrue(part.end_lba <= end < device_sector_number, msg="测试不小于原分区结束扇区")
+      if end > part.end_lba:
+        self.assertEqual(((end + 1) * 512 - topology.alignment_offset) % topology.grain, 0, msg="测试结束扇区对齐")
+
+
+  def test_misalignment_penalty(self):
+    """测试测量从63扇区开始的分区在4K物理块上的读取延迟"""
+    topology = IOTopology(self.device, 512)
+    topology.physical_block_size = topology.grain = 4096
+    latency = measure_misalignment_penalty(self.device, topology, 63, 2048 * 1024)
+    self.assertTrue(latency is not None, msg="测试测量未对齐读取延迟")
+    aligned_ms, misaligned_ms = latency
+    self.assertTrue(aligned_ms > 0 and misaligned_ms > 0)
+
+
   # def run(self, result=None):
   #     """ Stop after first error """
   #     if not result.errors: